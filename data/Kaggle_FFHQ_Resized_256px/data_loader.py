@@ -2,9 +2,14 @@
 
 import torch.utils.data as data
 import os
-from PIL import Image
 import pandas as pd
-from torchvision import transforms
+from torchvision.io import ImageReadMode, read_image
+
+# The v2 transforms are faster on tensors, fall back to the v1 tensor transforms on older torchvision versions
+try:
+    from torchvision.transforms import v2 as transforms
+except ImportError:
+    from torchvision import transforms
 
 
 class FFHQ(data.Dataset):
@@ -24,12 +29,11 @@ class FFHQ(data.Dataset):
         # Import labels from a CSV file
         self.labels = pd.read_csv(os.path.join(self.root, "ffhq_aging_labels.csv"))
 
-        # Image transformation
+        # Image transformation, applied to the uint8 tensor of the decoded image.
+        # The images stay uint8 so they are cheaper to copy to the GPU, where they are converted and normalized.
         self.transform = transforms.Compose([
-            transforms.Resize(224),  # Used to be resize 256
+            transforms.Resize(224, antialias=True),  # Used to be resize 256
             # transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
 
         # Make a lookup dictionary for the labels
@@ -43,7 +47,7 @@ class FFHQ(data.Dataset):
 
 
     def __getitem__(self, index):
-        _img = self.transform(Image.open(self.images[index]))
+        _img = self.transform(read_image(self.images[index], ImageReadMode.RGB))
         _label = self.one_hot_encoding[self.labels.iloc[index, self.class_id]]
         return _img, _label
 
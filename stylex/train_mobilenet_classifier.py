@@ -1,43 +1,173 @@
 import argparse
+import inspect
 import json
+import math
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 import numpy as np
 import torch
+import torch.distributed as dist
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.tensorboard import SummaryWriter
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 # Dataset utils
 from data.Kaggle_FFHQ_Resized_256px import ffhq_utils
 
-def set_seed(seed):
+def set_seed(seed, deterministic=False):
     """
     Function for setting the seed for reproducibility.
+    By default cuDNN autotuning and TF32 are enabled for speed, with deterministic set to True they are turned off
+    and cuDNN only uses deterministic algorithms.
     """
     np.random.seed(seed)
     torch.manual_seed(seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed(seed)
         torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.determinstic = True
-    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
+    torch.backends.cuda.matmul.allow_tf32 = not deterministic
+    torch.backends.cudnn.allow_tf32 = not deterministic
 
 
-def save_model(model, checkpoint_name):
+def dataloader_kwargs(device):
+    """
+    Returns the keyword arguments shared by all data loaders, using multiple persistent workers and pinned memory
+    so batches are prepared while the GPU is busy and can be copied to the device asynchronously.
+
+    Args:
+        device: Device the batches will be sent to.
+    Returns:
+        kwargs: Dictionary of keyword arguments for the DataLoader.
+    """
+    return {"num_workers": min(8, os.cpu_count() or 1), "pin_memory": device.type == 'cuda',
+            "persistent_workers": True, "prefetch_factor": 4}
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a data loader and copies the next batch to the device on a side CUDA stream while the current batch is
+    being processed, hiding the host to device transfer behind the computation. The uint8 images are normalized on
+    the device after the copy. On the CPU batches are simply moved to the device and normalized.
+    """
+    def __init__(self, loader, device, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        """
+        Args:
+            loader: The data loader to prefetch batches from, yielding uint8 images.
+            device: Device to send the batches to.
+            mean: Per channel mean to normalize the images with, for images in the range [0, 1].
+            std: Per channel standard deviation to normalize the images with, for images in the range [0, 1].
+        """
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device) if device.type == 'cuda' else None
+
+        # Scale the statistics to the [0, 255] range of the uint8 images
+        self.mean = torch.tensor(mean, device=device).view(1, 3, 1, 1) * 255
+        self.std = torch.tensor(std, device=device).view(1, 3, 1, 1) * 255
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self, iterator):
+        """
+        Starts copying the next batch of the iterator to the device.
+
+        Args:
+            iterator: Iterator over the wrapped data loader.
+        Returns:
+            batch: Tuple of images and targets on the device, or None if the iterator is exhausted.
+        """
+        try:
+            images, targets = next(iterator)
+        except StopIteration:
+            return None
+
+        # Images are sent in the channels last memory format the model uses
+        if self.stream is None:
+            images = images.to(self.device, memory_format=torch.channels_last)
+            return self.normalize(images), targets.to(self.device)
+
+        with torch.cuda.stream(self.stream):
+            images = images.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+            return self.normalize(images), targets.to(self.device, non_blocking=True)
+
+    def normalize(self, images):
+        """
+        Converts a batch of uint8 images on the device to normalized floats.
+
+        Args:
+            images: Batch of uint8 images on the device.
+        Returns:
+            images: Batch of normalized float images.
+        """
+        return images.float().sub_(self.mean).div_(self.std)
+
+    def __iter__(self):
+        # Make sure work queued on the current stream, such as scaling the statistics, is done before prefetching
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+
+        iterator = iter(self.loader)
+        batch = self.preload(iterator)
+        while batch is not None:
+            if self.stream is not None:
+                # Wait for the copy of this batch and make sure its memory is not reused while it is still in use
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for tensor in batch:
+                    tensor.record_stream(current_stream)
+
+            # Start copying the next batch before handing out the current one
+            next_batch = self.preload(iterator)
+            yield batch
+            batch = next_batch
+
+
+def unwrap_model(model):
+    """
+    Returns the original module of a model that may be wrapped by torch.compile and/or DistributedDataParallel.
+
+    Args:
+        model: nn.Module object, possibly wrapped.
+    Returns:
+        model: The original nn.Module object, sharing its parameters with the wrapped model.
+    """
+    model = getattr(model, "_orig_mod", model)
+    return model.module if isinstance(model, DDP) else model
+
+
+def save_model(model, checkpoint_name, executor=None):
     """
     Saves the model parameters to a checkpoint file.
 
     Args:
         model: nn.Module object representing the model architecture.
         checkpoint_name: Name of the checkpoint file.
+        executor: Optional executor to write the checkpoint in the background with, so training can continue.
+    Returns:
+        future: Future of the background write if an executor was given, otherwise None.
     """
     # Check if the saved_model directory exists, if not create it
     if not os.path.exists("saved_models"):
         os.mkdir("saved_models")
 
-    torch.save(model.state_dict(), os.path.join("saved_models", checkpoint_name))
+    # Save the weights of the original module so the checkpoint does not depend on torch.compile or DDP
+    model = unwrap_model(model)
+
+    # Copy the weights to the CPU so they do not change while they are written
+    state_dict = {key: value.detach().to("cpu", copy=True) for key, value in model.state_dict().items()}
+    path = os.path.join("saved_models", checkpoint_name)
+    if executor is None:
+        torch.save(state_dict, path)
+        return None
+    return executor.submit(torch.save, state_dict, path)
 
 
 def load_model(model, checkpoint_name):
@@ -50,12 +180,20 @@ def load_model(model, checkpoint_name):
     Returns:
         model: nn.Module object representing the model architecture.
     """
-    device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
-    model.load_state_dict(torch.load(os.path.join("saved_models", checkpoint_name), map_location=device))
+    # Load the weights to the device the model is on, which differs per process when training distributed
+    device = next(model.parameters()).device
+
+    # Memory map the checkpoint and only unpickle tensors, on PyTorch versions that support it
+    load_kwargs = {key: True for key in ("mmap", "weights_only") if key in inspect.signature(torch.load).parameters}
+
+    # A wrapped model shares its parameters with the original module, which is what the checkpoint was saved from
+    unwrap_model(model).load_state_dict(
+        torch.load(os.path.join("saved_models", checkpoint_name), map_location=device, **load_kwargs))
     return model
 
 
-def train_model(model, lr, batch_size, epochs, checkpoint_name, device, train_dataset, val_dataset):
+def train_model(model, lr, batch_size, epochs, checkpoint_name, device, train_dataset, val_dataset, accum_steps=1,
+                rank=0, world_size=1):
     """
     Trains a given model architecture for the specified hyperparameters.
 
@@ -68,83 +206,156 @@ def train_model(model, lr, batch_size, epochs, checkpoint_name, device, train_da
         device: Device to use for training.
         train_dataset: The training dataset.
         val_dataset: The validation dataset.
+        accum_steps: Number of batches to accumulate the gradients over before each optimizer step.
+        rank: Rank of this process when training distributed, only rank 0 logs and saves checkpoints.
+        world_size: Amount of processes training distributed, the batch size is split over them.
     Returns:
         model: Model that has performed best on the validation set.
 
     """
     assert epochs > 0, "To train the model the amount of epochs has to be higher than 1."
+    assert accum_steps > 0, "The amount of gradient accumulation steps has to be at least 1."
+    is_ddp = world_size > 1
+    is_main = rank == 0
 
-    # Make dataloaders from the datasets
-    train_loader = DataLoader(train_dataset, batch_size=batch_size,
-                              generator=torch.Generator().manual_seed(42), pin_memory=True, num_workers=6)
-    valid_loader = DataLoader(val_dataset, batch_size=batch_size,
-                              generator=torch.Generator().manual_seed(42), pin_memory=True, num_workers=6)
+    # Every process gets its share of the batch size, rounded up like in the StylEx training code
+    rank_batch_size = math.ceil(batch_size / world_size)
+    if is_main:
+        print(f"Effective batch size: {rank_batch_size * world_size * accum_steps}")
 
-    # Initializing the optimizer
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    # Make dataloaders from the datasets
+    # Only the training data is shuffled, the seeded generator keeps the order reproducible.
+    # When training distributed every process gets its own shard of the training data.
+    sampler = DistributedSampler(train_dataset, rank=rank, num_replicas=world_size,
+                                 shuffle=True, seed=42) if is_ddp else None
+    train_loader = DataLoader(train_dataset, batch_size=rank_batch_size, sampler=sampler,
+                              shuffle=not is_ddp, drop_last=True, generator=torch.Generator().manual_seed(42),
+                              **dataloader_kwargs(device))
+    valid_loader = DataLoader(val_dataset, batch_size=batch_size, **dataloader_kwargs(device))
+
+    # Copy the training batches to the device while the previous batch is being processed
+    train_prefetcher = CUDAPrefetcher(train_loader, device)
+
+    # Initializing the optimizer, with the fused CUDA kernel on PyTorch versions that have it
+    optimizer_kwargs = {}
+    if device.type == 'cuda' and "fused" in inspect.signature(torch.optim.Adam).parameters:
+        optimizer_kwargs["fused"] = True
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr, **optimizer_kwargs)
 
     # Define loss
     loss = nn.CrossEntropyLoss()
 
+    # Mixed precision is only used on the GPU, on the CPU the scaler and autocast are no-ops.
+    use_amp = device.type == 'cuda'
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+
     # Placeholder for saving the best model.
     best_valid_accuracy = 0
 
-    # Use tensorboard to visualize the training process.
-    writer = SummaryWriter(log_dir='./tboard_logs')
+    # Use tensorboard to visualize the training process, buffering the events until they are flushed each epoch.
+    writer = SummaryWriter(log_dir='./tboard_logs', max_queue=1000) if is_main else None
+
+    # Write checkpoints in a background thread, one at a time.
+    checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+    checkpoint_future = None
+
+    # The amount of batches does not change between epochs, and the loss is only logged and printed every few batches
+    n_batches = len(train_loader)
+    log_every = 50
+    print_every = 100
 
     # Training loop with validation after each epoch. Save the best model, and remember to use the lr scheduler.
     for epoch in range(epochs):
         start_epoch_time = time.time()
-        train_losses = []
+        if is_ddp:
+            sampler.set_epoch(epoch)
+
+        # Keep the running loss and accuracy on the device so they only have to be synchronized when they are logged
+        loss_sum = torch.zeros((), device=device)
+        loss_count = 0
+        train_correct = torch.zeros((), dtype=torch.long, device=device)
+        train_total = 0
 
         # Training loop
-        for batch_num, batch in enumerate(train_loader):
-            # Send data to device
+        for batch_num, batch in enumerate(train_prefetcher):
+            # The prefetcher has already sent the data to the device
             images, targets = batch
-            images, targets = images.to(device), targets.to(device)
-
-            # Send images through the model
-            predictions = model(images)
-
-            # Calculate loss
-            batch_loss = loss(predictions, targets)
-            train_losses.append(batch_loss.item())
-
-            # Log the loss
-            writer.add_scalar('Loss/train', batch_loss.item(), epoch * len(train_loader) + batch_num)
 
-            if batch_num % 1 == 0 or batch_num == len(train_loader) - 1:
-                print('\r',
-                      f"Epoch: {epoch}: batch {batch_num + 1}/{len(train_loader)}"
-                      f", running loss: {np.average(train_losses)}", end='')
-
-            # Reset gradients
-            optimizer.zero_grad()
-
-            # Perform backward pass and optimization
-            batch_loss.backward()
-            optimizer.step()
-
-        # Validation and train accuracy
+            # Only synchronize the gradients between processes on batches the optimizer steps on
+            last_batch = batch_num == n_batches - 1
+            optimizer_step = (batch_num + 1) % accum_steps == 0 or last_batch
+
+            # The last group of an epoch can have fewer than accum_steps batches, average over its actual size
+            group_start = batch_num - batch_num % accum_steps
+            group_size = min(accum_steps, n_batches - group_start)
+            sync_context = model.no_sync() if is_ddp and not optimizer_step else nullcontext()
+
+            with sync_context:
+                # Send images through the model and calculate the loss in mixed precision
+                with torch.cuda.amp.autocast(enabled=use_amp):
+                    predictions = model(images)
+                    batch_loss = loss(predictions, targets)
+
+                # Perform backward pass on the scaled loss, averaged over the accumulated batches
+                scaler.scale(batch_loss / group_size).backward()
+
+            loss_sum += batch_loss.detach()
+            loss_count += 1
+            train_correct += (torch.argmax(predictions.detach(), dim=1) == targets).sum()
+            train_total += targets.size(0)
+
+            # Log the running loss every log_every batches and print it every print_every batches
+            if is_main and (batch_num % log_every == 0 or last_batch):
+                running_loss = (loss_sum / loss_count).item()
+                writer.add_scalar('Loss/train', running_loss, epoch * n_batches + batch_num)
+                if batch_num % print_every == 0 or last_batch:
+                    print('\r',
+                          f"Epoch: {epoch}: batch {batch_num + 1}/{n_batches}"
+                          f", running loss: {running_loss:.4f}", end='')
+
+            # Optimize and reset gradients once enough batches have been accumulated or the epoch ends
+            if optimizer_step:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+
+        # The train accuracy is the running accuracy of this epoch, only the validation set is evaluated again.
+        # When training distributed the counts of all shards are summed.
+        if is_ddp:
+            train_counts = torch.stack([train_correct, torch.tensor(train_total, device=device)])
+            dist.all_reduce(train_counts)
+            train_correct, train_total = train_counts
+        train_epoch_accuracy = (train_correct.float() / train_total).item()
         model.eval()
-        with torch.no_grad():
-            train_epoch_accuracy = evaluate_model(model, train_loader, device)
+        with torch.inference_mode():
+            # Every process evaluates the full validation set, so they all agree on the best model
             valid_epoch_accuracy = evaluate_model(model, valid_loader, device)
-            print(f", train accuracy: {train_epoch_accuracy}, validation accuracy: {valid_epoch_accuracy}, epoch took: "
-                  f"{(time.time() - start_epoch_time) / 60:.2f} minutes")
 
             # Save model if it is the best model on the validation set.
             if valid_epoch_accuracy > best_valid_accuracy:
-                save_model(model, checkpoint_name)
+                if is_main:
+                    checkpoint_future = save_model(model, checkpoint_name, checkpoint_executor)
                 best_valid_accuracy = valid_epoch_accuracy
 
-            # Log the accuracy
+        if is_main:
+            print(f", train accuracy: {train_epoch_accuracy}, validation accuracy: {valid_epoch_accuracy}, epoch took: "
+                  f"{(time.time() - start_epoch_time) / 60:.2f} minutes")
+
+            # Log the accuracy and only write the buffered logs to disk once per epoch
             writer.add_scalar('Accuracy/train', train_epoch_accuracy, epoch)
             writer.add_scalar('Accuracy/validation', valid_epoch_accuracy, epoch)
+            writer.flush()
         model.train()
 
-    # Load best model and return it.
-    model = load_model(model, checkpoint_name).to(device)
+    # Wait for the last checkpoint to be written (raising any error from writing it), then load the best model.
+    if checkpoint_future is not None:
+        checkpoint_future.result()
+    checkpoint_executor.shutdown()
+
+    # The other processes wait until the first process has written the checkpoint
+    if is_ddp:
+        dist.barrier()
+    model = load_model(model, checkpoint_name)
 
     return model
 
@@ -160,26 +371,27 @@ def evaluate_model(model, data_loader, device):
     Returns:
         accuracy: The accuracy on the dataset.
     """
-    correct_predictions = 0
+    # Count the correct predictions on the device to avoid a synchronization per batch
+    correct_predictions = torch.zeros((), dtype=torch.long, device=device)
     number_examples = 0
-    for images, targets in data_loader:
-        # Send data to device
-        images, targets = images.to(device), targets.to(device)
-        predictions = model(images)
+    with torch.inference_mode():
+        for images, targets in CUDAPrefetcher(data_loader, device):
+            with torch.cuda.amp.autocast(enabled=device.type == 'cuda'):
+                predictions = model(images)
 
-        # Calculate number of correct predictions
-        predicted_labels = torch.argmax(predictions, dim=1)
-        correct_predictions += sum(predicted_labels == targets)
-        number_examples += len(targets)
+            # Calculate number of correct predictions
+            predicted_labels = torch.argmax(predictions, dim=1)
+            correct_predictions += (predicted_labels == targets).sum()
+            number_examples += targets.size(0)
 
-    accuracy = correct_predictions / number_examples
+    accuracy = (correct_predictions.float() / number_examples).item()
 
     return accuracy
 
 
-def test_model(model, batch_size, device, seed, test_dataset):
+def test_model(model, batch_size, device, seed, test_dataset, deterministic=False):
     """
-    Tests a trained model on the test set with all corruption functions.
+    Tests a trained model on the test set with all corruption functions. The model is left in evaluation mode.
 
     Args:
         model: Model architecture to test.
@@ -187,28 +399,24 @@ def test_model(model, batch_size, device, seed, test_dataset):
         device: Device to use for training.
         seed: The seed to set before testing to ensure a reproducible test.
         test_dataset: The test dataset to use.
+        deterministic: If true, cuDNN is set to only use deterministic algorithms.
     Returns:
         test_results: Dictionary containing an overview of the accuracy.
     """
-    set_seed(seed)
+    set_seed(seed, deterministic)
 
     # Set model to evaluation mode
     model.eval()
 
     test_results = {}
 
-    with torch.no_grad():
-        test_loader = DataLoader(test_dataset, batch_size=batch_size,
-                                 generator=torch.Generator().manual_seed(42), pin_memory=True,
-                                 num_workers=6)
+    with torch.inference_mode():
+        test_loader = DataLoader(test_dataset, batch_size=batch_size, **dataloader_kwargs(device))
         accuracy = evaluate_model(model, test_loader, device)
-        test_results['accuracy'] = accuracy.item()
+        test_results['accuracy'] = accuracy
 
         # Test accuracy
-        print(f"Test accuracy: {accuracy.item():.4f}")
-
-    # Set model back to train mode
-    model.train()
+        print(f"Test accuracy: {accuracy:.4f}")
 
     return test_results
 
@@ -240,12 +448,25 @@ def load_mobilenet(device, amount_frozen_layers=15, freeze_all_layer=False):
 
 def main(args: argparse.Namespace):
     """
-    Main function for training a classifier.
+    Main function for training a classifier. Launch with torchrun --nproc_per_node=N to train on N GPUs.
     :param args: Arguments from the command line.
     """
+    # Train distributed when launched with torchrun on multiple processes, with one GPU per process
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    is_ddp = world_size > 1
+    rank = int(os.environ.get("RANK", 0))
+    if is_ddp:
+        local_rank = int(os.environ["LOCAL_RANK"])
+        dist.init_process_group('nccl')
+        torch.cuda.set_device(local_rank)
+        print(f"{rank + 1}/{world_size} process initialized.")
+
     # Define device and seed
-    device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
-    set_seed(args.seed)
+    if is_ddp:
+        device = torch.device(f"cuda:{local_rank}")
+    else:
+        device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
+    set_seed(args.seed, args.deterministic)
 
     if args.dataset == "FFHQ-Aging":
         train_dataset, valid_dataset, test_dataset = ffhq_utils.get_train_valid_test_dataset(
@@ -255,21 +476,35 @@ def main(args: argparse.Namespace):
 
     model = load_mobilenet(device, args.amount_frozen_layers, args.freeze_all_layers)
 
+    # The convolutions of MobileNet are faster in the channels last (NHWC) memory format
+    model = model.to(memory_format=torch.channels_last)
+
+    if is_ddp:
+        model = DDP(model, device_ids=[local_rank])
+
+    # Fuse the kernels of the model, the training loader drops its last batch so the input shape stays fixed
+    if hasattr(torch, 'compile') and device.type == 'cuda':
+        model = torch.compile(model, mode='reduce-overhead')
+
     # Check if model was already trained, if it was import it, if not train it
     if not os.path.exists(os.path.join("saved_models", args.checkpoint_name)):
         train_model(model, args.lr, args.batch_size, args.epochs, args.checkpoint_name, device, train_dataset,
-                    valid_dataset)
+                    valid_dataset, args.accum_steps, rank, world_size)
     else:
-        model = load_model(model, args.checkpoint_name).to(device)
+        model = load_model(model, args.checkpoint_name)
         if args.continue_training:
             train_model(model, args.lr, args.batch_size, args.epochs, args.checkpoint_name, device, train_dataset,
-                        valid_dataset)
+                        valid_dataset, args.accum_steps, rank, world_size)
 
     # Then test the model with all the defined corruption features
     # Return the results
-    test_results = test_model(model, args.batch_size, device, args.seed, test_dataset)
+    test_results = test_model(model, args.batch_size, device, args.seed, test_dataset, args.deterministic)
 
-    return test_results
+    if is_ddp:
+        dist.destroy_process_group()
+
+    # Only the first process reports the results
+    return test_results if rank == 0 else None
 
 
 if __name__ == "__main__":
@@ -293,12 +528,16 @@ if __name__ == "__main__":
                         help='Learning rate to use')
     parser.add_argument('--batch_size', default=200, type=int,  # Was 38 when training all the weights
                         help='Minibatch size')
+    parser.add_argument('--accum_steps', default=1, type=int,
+                        help='Number of minibatches to accumulate gradients over before each optimizer step')
 
     # Other hyperparameters
     parser.add_argument('--epochs', default=50, type=int,
                         help='Max number of epochs')
     parser.add_argument('--seed', default=42, type=int,
                         help='Seed to use for reproducing results')
+    parser.add_argument('--deterministic', dest="deterministic", action="store_true",
+                        help='Use deterministic cuDNN algorithms instead of autotuning and TF32')
     parser.add_argument('--checkpoint_name', default="FFHQ-Gender.pth", type=str, help="Name of the model checkpoint")
     parser.add_argument('--continue_training', dest="continue_training", action="store_true")
 
@@ -308,7 +547,8 @@ if __name__ == "__main__":
 
     # Write results to a json file with the same name as the checkpoint
     # First check if a folder called classifier_results exists, if not create it and save the csv file there
-    if not os.path.exists("classifier_results"):
-        os.mkdir("classifier_results")
-    with open(os.path.join("classifier_results", parse_args.checkpoint_name.split(".")[0] + ".json"), "w") as f:
-        json.dump(results, f)
+    if results is not None:
+        if not os.path.exists("classifier_results"):
+            os.mkdir("classifier_results")
+        with open(os.path.join("classifier_results", parse_args.checkpoint_name.split(".")[0] + ".json"), "w") as f:
+            json.dump(results, f)
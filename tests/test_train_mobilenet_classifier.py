@@ -0,0 +1,38 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("pandas")
+pytest.importorskip("tensorboard")
+
+# The training script is run from the repository root with the stylex folder as its script directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "stylex"))
+
+import train_mobilenet_classifier  # noqa: E402
+
+
+@pytest.mark.parametrize("use_executor", [False, True])
+def test_save_load_round_trip(tmp_path, monkeypatch, use_executor):
+    """
+    A checkpoint written by save_model can be read back by load_model with the same weights.
+    """
+    monkeypatch.chdir(tmp_path)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.BatchNorm1d(3))
+
+    if use_executor:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            train_mobilenet_classifier.save_model(model, "round_trip.pth", executor).result()
+    else:
+        train_mobilenet_classifier.save_model(model, "round_trip.pth")
+
+    loaded = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.BatchNorm1d(3))
+    loaded = train_mobilenet_classifier.load_model(loaded, "round_trip.pth")
+
+    for key, value in model.state_dict().items():
+        assert torch.equal(loaded.state_dict()[key], value)